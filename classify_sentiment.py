@@ -5,52 +5,214 @@
 """
 
 import argparse
+import asyncio
 import csv
+import hashlib
 import json
+import logging
+import mmap
 import os
-import re
+import random
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Optional, List
-import pandas as pd
+from typing import Dict, Iterator, Optional, List, Set, Tuple
 
 
 try:
-    from openai import OpenAI
+    import httpx
+    from openai import APIConnectionError, APIStatusError, AsyncOpenAI, RateLimitError
+    from tqdm import tqdm
+    from tqdm.contrib.logging import logging_redirect_tqdm
 except ImportError:
-    print("请先安装依赖: pip install openai")
+    print("请先安装依赖: pip install -r requirements.txt")
     exit(1)
 
+# 单条评论的错误、重试等信息走 logging，避免和进度条抢占输出
+logger = logging.getLogger("classify_sentiment")
 
-def extract_json_from_llm(text):
+# HTTP/2 需要 h2（pip install "httpx[http2]"），未安装时退回 HTTP/1.1 连接池
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# orjson 为可选依赖：解析/序列化更快，未安装时退回标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data):
+    """解析 JSON（str 或 bytes）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps_bytes(obj) -> bytes:
+    """
+    序列化为 UTF-8 编码的 JSON（不转义非 ASCII 字符）
+    CSV 行多出来的单元格会被 DictReader 放在 None 键下，与标准库 json 一样写成 "null"
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def comment_digest(key: str) -> bytes:
+    """评论去重用的定长摘要，避免在内存中保留评论全文"""
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+
+# 失败占位条目的保留键（下划线开头，避免与输入列或模型输出字段重名）
+FAILED_KEY = "_failed"
+
+
+# 缓存文件写缓冲大小，以及每写入多少条 fsync 一次
+CACHE_BUFFER_SIZE = 1 << 16
+CACHE_FSYNC_EVERY = 50
+
+# 429/5xx/连接错误后指数退避的基数和上限（秒）：等待 uniform(0, min(上限, 基数 * 2^重试次数))
+# Retry-After 也不超过上限
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+# 单次请求超时（秒）；批量模式下一次请求要生成多条结果，留足余量
+REQUEST_TIMEOUT = 120.0
+
+# 单条评论允许模型输出的最大 token 数
+MAX_COMPLETION_TOKENS = 2000
+# 批量请求的输出上限按条数累加，但不超过常见模型的输出上限（gpt-4o-mini 为 16384）
+MAX_BATCH_COMPLETION_TOKENS = 16000
+# 限流预估用的每条评论预期输出 token 数（按实际输出而不是上限扣额度，批量才能提高吞吐）
+EXPECTED_COMPLETION_TOKENS = 500
+
+# 输出文件每写入多少行 flush 一次
+OUTPUT_FLUSH_EVERY = 50
+
+
+def extract_json_from_llm(text, allow_array: bool = False):
     """
-    不管 AI 是否带 ```json，都能准确把字典提取出来
+    不管 AI 是否带 ```json，都能准确把字典（allow_array 时也可以是数组）提取出来
+    只用 find/rfind 线性扫描，不走正则引擎，避免长文本上的回溯
     """
-    # 1. 尝试匹配 Markdown 格式的 JSON 块
-    # 匹配 ```json ... ``` 或者 ``` ... ``` 里的内容
-    markdown_pattern = r"```(?:json)?\s*([\s\S]*?)\s*```"
-    match = re.search(markdown_pattern, text)
-    
-    if match:
-        json_str = match.group(1).strip()
-    else:
-        # 2. 如果没有 Markdown 标签，尝试寻找第一个 { 和最后一个 } 之间的内容
+    json_str = None
+    
+    # 1. 尝试截取 Markdown 格式的 JSON 块
+    # 即 ```json ... ``` 或者 ``` ... ``` 里的内容
+    start = text.find("```")
+    if start != -1:
+        end = text.find("```", start + 3)
+        if end != -1:
+            json_str = text[start + 3:end]
+            if json_str.startswith("json"):
+                json_str = json_str[4:]
+            json_str = json_str.strip()
+    
+    if json_str is None:
+        # 2. 如果没有 Markdown 标签，截取第一个 { 和最后一个 } 之间的内容
+        # （allow_array 且 [ ] 把所有 { } 都包在里面时则取数组）
         # 这种方式可以过滤掉 AI 在 JSON 前后说的废话
-        brace_pattern = r"(\{[\s\S]*\})"
-        match = re.search(brace_pattern, text)
-        if match:
-            json_str = match.group(1).strip()
+        start, end = text.find("{"), text.rfind("}")
+        if allow_array:
+            bracket_start, bracket_end = text.find("["), text.rfind("]")
+            if bracket_start != -1 and (start == -1 or (bracket_start < start and bracket_end > end)):
+                start, end = bracket_start, bracket_end
+        if start != -1 and end > start:
+            json_str = text[start:end + 1]
         else:
             # 3. 实在找不到，就死马当活马医，直接用原字符串
             json_str = text.strip()
 
     try:
         # 解析并返回 Python 字典
-        return json.loads(json_str)
+        return json_loads(json_str)
     except json.JSONDecodeError as e:
-        print(f"解析失败！原始文本: {text}")
+        logger.warning(f"解析失败！原始文本: {text}")
         return None
 
 
+def parse_llm_json(text, allow_array: bool = False):
+    """
+    解析模型输出：JSON 模式下输出本身就是合法 JSON，直接解析；
+    不支持 response_format 的 endpoint 再退回 extract_json_from_llm 做启发式提取
+    返回值可能是任意 JSON 值，调用方需自行检查类型
+    """
+    if not text:
+        return None
+    try:
+        return json_loads(text)
+    except json.JSONDecodeError:
+        return extract_json_from_llm(text, allow_array=allow_array)
+
+
+class CsvResultWriter:
+    """
+    逐行追加写入结果CSV
+    
+    表头在拿到第一条带模型解析字段的结果时确定：输入列 + raw_response + 模型返回的字段 + error。
+    在此之前到达的结果（失败、解析失败的）先暂存，确定表头后一并写出。
+    """
+    
+    def __init__(self, f, input_fields: List[str]):
+        self.f = f
+        self.input_fields = input_fields
+        self.base_fields = ["index", *input_fields, "raw_response"]
+        self.writer = None
+        self.fieldnames: Set[str] = set()
+        self.reported_extra: Set[str] = set()
+        self.pending: List[Dict] = []
+        self.rows_written = 0
+    
+    def _model_fields(self, item: Dict) -> List[str]:
+        """条目中来自模型解析结果的字段"""
+        return [k for k in item if k not in self.base_fields and k not in ("error", FAILED_KEY)]
+    
+    def _init_writer(self, model_fields: List[str]):
+        fieldnames = [*self.base_fields, *model_fields, "error"]
+        self.fieldnames = set(fieldnames)
+        # 表头之外的字段不写入，但会记录警告（完整内容仍保留在 raw_response 中）
+        self.writer = csv.DictWriter(self.f, fieldnames=fieldnames, restval="", extrasaction="ignore")
+        self.writer.writeheader()
+        for item in self.pending:
+            self._write(item)
+        self.pending = []
+    
+    def _write(self, item: Dict):
+        extra = [
+            k for k in item
+            if k not in self.fieldnames and k != FAILED_KEY and k not in self.reported_extra
+        ]
+        if extra:
+            self.reported_extra.update(extra)
+            logger.warning(f"结果中出现表头之外的字段，未写入输出CSV（见 raw_response）: {extra}")
+        self.writer.writerow(item)
+        self.rows_written += 1
+        if self.rows_written % OUTPUT_FLUSH_EVERY == 0:
+            self.f.flush()
+    
+    def write(self, item: Dict):
+        if self.writer is None:
+            model_fields = self._model_fields(item)
+            if not model_fields:
+                self.pending.append(item)
+                return
+            self._init_writer(model_fields)
+        self._write(item)
+    
+    def close(self):
+        # 没有任何带模型字段的结果时，用暂存条目字段的并集确定表头
+        if self.writer is None:
+            model_fields: Dict[str, None] = {}
+            for item in self.pending:
+                model_fields.update(dict.fromkeys(self._model_fields(item)))
+            self._init_writer(list(model_fields))
+        self.f.flush()
+
+
 class SentimentClassifier:
     """情感分类器"""
     
@@ -60,7 +222,11 @@ class SentimentClassifier:
         base_url: Optional[str] = None,
         model: str = "gpt-4o-mini",
         system_prompt_path: str = "prompts/nintendo_comment_classify.txt",
-        cache_dir: str = "cache"
+        cache_dir: str = "cache",
+        max_rpm: float = 500,
+        max_tpm: float = 200000,
+        json_mode: bool = True,
+        max_connections: int = 40
     ):
         """
         初始化分类器
@@ -71,16 +237,46 @@ class SentimentClassifier:
             model: 使用的模型名称
             system_prompt_path: 系统提示词文件路径
             cache_dir: 缓存目录，用于断点续传
+            max_rpm: 每分钟最大请求数
+            max_tpm: 每分钟最大 token 数
+            json_mode: 是否通过 response_format 要求模型只输出 JSON 对象
+            max_connections: HTTP 连接池大小
         """
-        self.client = OpenAI(
+        # 共享一个长连接池，复用 TCP/TLS 连接，支持时走 HTTP/2 多路复用
+        self.http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            ),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT)
+        )
+        # 关闭 SDK 自带的重试，由 _backoff 和令牌桶统一控制重试与限流
+        self.client = AsyncOpenAI(
             api_key=api_key,
-            base_url=base_url
+            base_url=base_url,
+            http_client=self.http_client,
+            max_retries=0
         )
         self.model = model
         self.system_prompt = self._load_system_prompt(system_prompt_path)
+        self.json_mode = json_mode
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(exist_ok=True)
+        self._cache_file = None
+        self._cache_unsynced = 0
         
+        # 令牌桶限流：请求额度和 token 额度按每秒 max/60 的速度回填
+        self.max_rpm = max_rpm
+        self.max_tpm = max_tpm
+        self.available_request_capacity = max_rpm
+        self.available_token_capacity = max_tpm
+        self.last_update_time = time.monotonic()
+        
+    async def aclose(self):
+        """关闭 HTTP 连接池"""
+        await self.http_client.aclose()
+    
     def _load_system_prompt(self, prompt_path: str) -> str:
         """加载系统提示词"""
         prompt_file = Path(prompt_path)
@@ -95,75 +291,372 @@ class SentimentClassifier:
         input_name = Path(input_file).stem
         return self.cache_dir / f"{input_name}_cache.jsonl"
     
-    def _load_cache(self, cache_path: Path) -> Dict[int, Dict]:
-        """加载已处理的缓存"""
-        cache = {}
+    def _iter_cache(self, cache_path: Path) -> Iterator[Dict]:
+        """逐条读取缓存中的完整条目，不在内存中保留"""
         if cache_path.exists():
-            with open(cache_path, 'r', encoding='utf-8') as f:
+            with open(cache_path, 'rb') as f:
                 for line in f:
-                    item = json.loads(line.strip())
-                    cache[item['index']] = item
-        return cache
+                    if line.strip():
+                        yield json_loads(line)
     
-    def _save_to_cache(self, cache_path: Path, item: Dict):
-        """追加保存到缓存文件"""
-        with open(cache_path, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(item, ensure_ascii=False) + '\n')
-    
-    def classify_comment(self, comment: str) -> Dict:
+    def _drop_partial_line(self, cache_path: Path):
         """
-        对单条评论进行情感分类
-        
-        Args:
-            comment: 评论文本
-            
-        Returns:
-            分类结果字典
+        上次运行若在写入中途崩溃，缓存末尾可能留下半行，
+        截掉它以保证文件里每一行都是完整条目
         """
+        if not cache_path.exists() or cache_path.stat().st_size == 0:
+            return
+        with open(cache_path, 'r+b') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[-1:] == b'\n':
+                    return
+                keep = mm.rfind(b'\n') + 1
+            logger.warning(f"缓存末尾有不完整的行，已丢弃 {cache_path.stat().st_size - keep} 字节")
+            f.truncate(keep)
+    
+    @contextmanager
+    def _open_cache(self, cache_path: Path):
+        """在整个处理过程中保持缓存文件打开，结束时 flush 并 fsync"""
+        self._cache_file = open(cache_path, 'ab', buffering=CACHE_BUFFER_SIZE)
+        self._cache_unsynced = 0
         try:
-            response = self.client.chat.completions.create(
+            yield
+        finally:
+            self._cache_file.flush()
+            os.fsync(self._cache_file.fileno())
+            self._cache_file.close()
+            self._cache_file = None
+    
+    def _save_to_cache(self, item: Dict):
+        """追加保存到缓存文件（先进缓冲区，每 CACHE_FSYNC_EVERY 条落盘一次）"""
+        self._cache_file.write(json_dumps_bytes(item) + b'\n')
+        self._cache_unsynced += 1
+        if self._cache_unsynced >= CACHE_FSYNC_EVERY:
+            self._cache_file.flush()
+            os.fsync(self._cache_file.fileno())
+            self._cache_unsynced = 0
+    
+    def _estimate_tokens(self, user_content: str, num_comments: int) -> float:
+        """粗略估算单次请求消耗的 token 数（约 4 字符 1 token，输出按预期长度计）"""
+        return (
+            len(self.system_prompt) / 4
+            + len(user_content) / 4
+            + EXPECTED_COMPLETION_TOKENS * num_comments
+        )
+    
+    async def _acquire_capacity(self, token_cost: float):
+        """等待直到请求额度和 token 额度都足够，再扣除本次请求的消耗"""
+        # 单次消耗超过桶容量时按桶容量计，避免永远等不到
+        token_cost = min(token_cost, self.max_tpm)
+        while True:
+            now = time.monotonic()
+            elapsed = now - self.last_update_time
+            self.available_request_capacity = min(
+                self.available_request_capacity + self.max_rpm * elapsed / 60,
+                self.max_rpm
+            )
+            self.available_token_capacity = min(
+                self.available_token_capacity + self.max_tpm * elapsed / 60,
+                self.max_tpm
+            )
+            self.last_update_time = now
+            
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= token_cost:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= token_cost
+                return
+            
+            await asyncio.sleep(0.05)
+    
+    def _get_retry_after(self, e: APIStatusError) -> Optional[float]:
+        """读取响应头 Retry-After（秒数形式），没有或无法解析时返回 None"""
+        try:
+            return float(e.response.headers.get('retry-after'))
+        except (TypeError, ValueError):
+            return None
+    
+    async def _backoff(self, retry: int, failure: Dict):
+        """429/5xx/连接错误后等待再重试：优先遵循 Retry-After（不超过 BACKOFF_CAP），否则指数退避加随机抖动"""
+        if not failure.get("retryable"):
+            return
+        delay = failure.get("retry_after")
+        if delay is None:
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** retry))
+        else:
+            delay = min(max(delay, 0.0), BACKOFF_CAP)
+        await asyncio.sleep(delay)
+    
+    async def _chat(self, user_content: str, num_comments: int = 1) -> Dict:
+        """发送一次请求（受令牌桶限流），返回模型原始输出；num_comments 为请求中包含的评论条数"""
+        await self._acquire_capacity(self._estimate_tokens(user_content, num_comments))
+        max_completion_tokens = min(MAX_COMPLETION_TOKENS * num_comments, MAX_BATCH_COMPLETION_TOKENS)
+        
+        extra_kwargs = {}
+        if self.json_mode:
+            extra_kwargs["response_format"] = {"type": "json_object"}
+        
+        try:
+            response = await self.client.chat.completions.create(
                 model=self.model,
                 messages=[
                     {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": comment}
+                    {"role": "user", "content": user_content}
                 ],
                 temperature=0,
-                max_completion_tokens=2000
+                max_completion_tokens=max_completion_tokens,
+                **extra_kwargs
             )
             
-            result = response.choices[0].message.content
-            
-            # 尝试解析为JSON
-            parsed_result = extract_json_from_llm(result)
+            content = response.choices[0].message.content
+            if not content:
+                # 推理模型把 max_completion_tokens 用完时常返回空内容，按失败处理以便重试
+                return {
+                    "success": False,
+                    "error": f"模型返回内容为空 (finish_reason={response.choices[0].finish_reason})"
+                }
             
             return {
                 "success": True,
-                "result": parsed_result,
-                "raw_response": result
+                "raw_response": content
             }
             
-        except Exception as e:
+        except RateLimitError as e:
+            # 触发 429 说明预估偏乐观，额度减半（AIMD）
+            self.available_request_capacity /= 2
+            self.available_token_capacity /= 2
+            return {
+                "success": False,
+                "error": str(e),
+                "retryable": True,
+                "retry_after": self._get_retry_after(e)
+            }
+        except APIStatusError as e:
+            # 5xx 是服务端临时故障，退避后重试；其余 4xx 重试也没用，不必等待
+            return {
+                "success": False,
+                "error": str(e),
+                "retryable": e.status_code >= 500,
+                "retry_after": self._get_retry_after(e)
+            }
+        except APIConnectionError as e:
+            # 网络抖动和超时（APITimeoutError 是其子类）也是临时故障，退避后重试
             return {
                 "success": False,
                 "error": str(e),
+                "retryable": True,
+                "retry_after": None
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
+    async def classify_comment(self, comment: str) -> Dict:
+        """
+        对单条评论进行异步情感分类
+        
+        Args:
+            comment: 评论文本
+            
+        Returns:
+            分类结果字典
+        """
+        response = await self._chat(comment)
+        if not response["success"]:
+            return {
+                **response,
+                "result": None
+            }
+        
+        result = response["raw_response"]
+        
+        # 尝试解析为JSON；不是 JSON 对象（解析失败、数组、字符串等）视为失败，交给重试
+        parsed_result = parse_llm_json(result)
+        if not isinstance(parsed_result, dict):
+            return {
+                "success": False,
+                "error": "模型输出不是 JSON 对象",
                 "result": None
             }
+        
+        return {
+            "success": True,
+            "result": parsed_result,
+            "raw_response": result
+        }
     
-    def process_csv(
+    async def classify_batch(self, comments: List[str]) -> Dict:
+        """
+        把多条评论打包进一次请求进行分类，系统提示词只发送一次
+        
+        Args:
+            comments: 评论文本列表
+            
+        Returns:
+            分类结果字典，results 为与 comments 一一对应的结果列表；
+            模型返回的 results 不是等长的对象数组时视为失败
+        """
+        k = len(comments)
+        user_content = (
+            f"请分别对以下 {k} 条评论进行分类。评论以 JSON 字符串数组给出。"
+            f"只返回一个 JSON 对象，格式为 {{\"results\": [...]}}，"
+            f"results 是包含 {k} 个对象的数组，顺序与评论一致，"
+            f"每个对象的格式与单条评论的分类结果相同。\n\n"
+            + json_dumps_bytes(comments).decode('utf-8')
+        )
+        response = await self._chat(user_content, num_comments=k)
+        if not response["success"]:
+            return {
+                **response,
+                "results": None
+            }
+        
+        result = response["raw_response"]
+        parsed_result = parse_llm_json(result, allow_array=True)
+        # JSON 模式只允许顶层为对象，数组包在 results 里；也兼容直接返回数组的情况
+        if isinstance(parsed_result, dict):
+            parsed_result = parsed_result.get("results")
+        if (
+            not isinstance(parsed_result, list)
+            or len(parsed_result) != k
+            or not all(isinstance(r, dict) for r in parsed_result)
+        ):
+            return {
+                "success": False,
+                "error": f"批量结果不是 {k} 个对象的数组",
+                "results": None
+            }
+        
+        return {
+            "success": True,
+            "results": parsed_result,
+            "raw_response": result
+        }
+    
+    async def _classify_row(
+        self,
+        idx: int,
+        row: Dict,
+        comment: str,
+        total: int,
+        max_retries: int
+    ) -> Dict:
+        """带重试地分类单行评论，返回要写入结果的条目"""
+        # 重试机制
+        for retry in range(max_retries):
+            classification = await self.classify_comment(comment)
+            
+            if classification["success"]:
+                item = {
+                    "index": idx,
+                    **{k: v for k, v in row.items()},
+                    "raw_response": classification["raw_response"],
+                }
+                item.update(classification["result"])
+                # 保存到缓存（写入之间没有 await，协程间不会交错）
+                self._save_to_cache(item)
+                return item
+            else:
+                logger.warning(
+                    f"[{idx+1}/{total}] 错误 (尝试 {retry+1}/{max_retries}): {classification['error']}"
+                )
+                if retry + 1 < max_retries:
+                    await self._backoff(retry, classification)
+        
+        logger.warning(f"[{idx+1}/{total}] 处理失败，跳过")
+        item = self._failed_item(idx, row)
+        # 失败也写入缓存，续跑时默认跳过（--retry-failed 时重新请求）
+        self._save_to_cache(item)
+        return item
+    
+    async def _classify_batch_rows(
+        self,
+        jobs: List[Tuple[int, Dict, str]],
+        total: int,
+        max_retries: int
+    ) -> List[Dict]:
+        """批量分类多行评论；整批解析失败时退回逐条分类"""
+        classification = await self.classify_batch([comment for _, _, comment in jobs])
+        if not classification["success"]:
+            first, last = jobs[0][0], jobs[-1][0]
+            logger.warning(
+                f"[{first+1}-{last+1}/{total}] 批量分类失败，改为逐条分类: {classification['error']}"
+            )
+            await self._backoff(0, classification)
+            # 在当前 worker 内逐条请求，保证同时在途的请求数不超过 --concurrency
+            return [
+                await self._classify_row(idx, row, comment, total, max_retries)
+                for idx, row, comment in jobs
+            ]
+        
+        items = []
+        for (idx, row, _), result in zip(jobs, classification["results"]):
+            item = {
+                "index": idx,
+                **{k: v for k, v in row.items()},
+                # 每行只保留自己那一份结果，便于和单条模式的输出对齐
+                "raw_response": json_dumps_bytes(result).decode('utf-8'),
+            }
+            item.update(result)
+            # 逐条写缓存，断点续传粒度不变
+            self._save_to_cache(item)
+            items.append(item)
+        return items
+    
+    def _failed_item(self, idx: int, row: Dict) -> Dict:
+        """构造失败占位条目，用保留键 FAILED_KEY 标记"""
+        item = {
+            "index": idx,
+            FAILED_KEY: True,
+            **{k: v for k, v in row.items()},
+            "raw_response": None,
+            "error": "error!",
+        }
+        # 输入里恰好有同名列时也以失败标记为准（键的位置不变）
+        item[FAILED_KEY] = True
+        return item
+    
+    def _reuse_result(self, idx: int, row: Dict, result: Optional[Dict]) -> Dict:
+        """
+        把相同评论的分类结果套到另一行上；result 只含模型解析出的字段，为 None 表示那次请求失败
+        raw_response 由解析结果重新序列化得到，与批量模式一致
+        """
+        if result is None:
+            item = self._failed_item(idx, row)
+        else:
+            item = {
+                "index": idx,
+                **{k: v for k, v in row.items()},
+                "raw_response": json_dumps_bytes(result).decode('utf-8'),
+                **result,
+            }
+        # 每个重复行单独写缓存，缓存格式与断点续传不变
+        self._save_to_cache(item)
+        return item
+    
+    async def process_csv(
         self,
         input_file: str,
         output_file: str,
         comment_fields: List[str] = ["comment"],
-        max_retries: int = 3
+        max_retries: int = 3,
+        concurrency: int = 20,
+        batch_size: int = 1,
+        retry_failed: bool = False
     ):
         """
-        处理CSV文件中的评论
+        流式处理CSV文件中的评论，由 concurrency 个 worker 并发请求，
+        每次请求打包 batch_size 条评论
         
         Args:
             input_file: 输入CSV文件路径
             output_file: 输出JSON文件路径
             comment_field: 评论字段名
             max_retries: 最大重试次数
+            concurrency: 并发 worker 数
+            batch_size: 每次请求包含的评论条数
+            retry_failed: 是否重新请求缓存中标记为失败的评论
         """
         input_path = Path(input_file)
         if not input_path.exists():
@@ -171,77 +664,146 @@ class SentimentClassifier:
         
         # 加载缓存
         cache_path = self._get_cache_path(input_file)
-        cache = self._load_cache(cache_path)
-        print(f"已加载缓存: {len(cache)} 条记录")
+        self._drop_partial_line(cache_path)
+        # 已处理的 index，在写出缓存条目的同一遍扫描中收集
+        cache: Set[int] = set()
+        
+        # 先用 csv.reader 数一遍行数（只用于进度显示，不保留行数据）
+        with open(input_path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            input_fields = next(reader, [])
+            total = sum(1 for _ in reader)
+        print(f"总共 {total} 条评论需要处理，并发数: {concurrency}，每批: {batch_size} 条")
         
-        # 读取CSV
-        with open(input_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
+        output_path = Path(output_file)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        stats = {"success": 0, "failed": 0, "reused": 0}
+        # 相同评论（去掉首尾空白后）只请求一次，以评论摘要为键：
+        # pending 记录请求进行中时遇到的重复行，
+        # finished 记录已完成评论（含缓存中的）模型解析出的字段（失败为 None），不保留全文和 raw_response
+        pending: Dict[bytes, List[Tuple[int, Dict]]] = {}
+        finished: Dict[bytes, Optional[Dict]] = {}
         
-        total = len(rows)
-        print(f"总共 {total} 条评论需要处理")
+        def parsed_fields(item: Dict) -> Dict:
+            excluded = {"index", "raw_response", *input_fields}
+            return {k: v for k, v in item.items() if k not in excluded}
+        # 有界队列：生产者边读边投递，读得比请求快时自动阻塞，内存占用与文件大小无关
+        job_queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
         
-        # 处理每条评论
-        results = []
-        for idx, row in enumerate(rows):
-            # 检查是否已处理
-            if idx in cache:
-                print(f"[{idx+1}/{total}] 已缓存，跳过")
-                results.append(cache[idx])
-                continue
+        # 结果按完成顺序逐行写出，可按 index 列恢复原始顺序
+        # 进度条每完成一行（含缓存、复用和空评论）前进一格
+        with open(output_path, 'w', encoding='utf-8-sig', newline='') as out_f, \
+                self._open_cache(cache_path), \
+                tqdm(total=total, unit="条", desc="分类") as progress, \
+                logging_redirect_tqdm():
+            result_writer = CsvResultWriter(out_f, input_fields)
+            
+            def emit(item: Dict):
+                progress.update(1)
+                result_writer.write(item)
+                if item.get("raw_response"):
+                    stats["success"] += 1
+                else:
+                    stats["failed"] += 1
             
-            comment = " ".join([row.get(field, "") for field in comment_fields])
-            if not comment.strip():
-                print(f"[{idx+1}/{total}] 评论为空，跳过")
-                continue
+            def emit_reused(idx: int, row: Dict, result: Optional[Dict]):
+                stats["reused"] += 1
+                emit(self._reuse_result(idx, row, result))
             
-            # 重试机制
-            success = False
-            for retry in range(max_retries):
-                print(f"[{idx+1}/{total}] 正在分类... (尝试 {retry+1}/{max_retries})")
+            def emit_done(jobs: List[Tuple[int, Dict, str]], items: List[Dict]):
+                # 写出本次请求的结果，并分发给等待中的重复评论
+                for (_, row, comment), item in zip(jobs, items):
+                    emit(item)
+                    key = comment_digest(comment.strip())
+                    result = parsed_fields(item) if item.get("raw_response") else None
+                    finished[key] = result
+                    for dup_idx, dup_row in pending.pop(key, []):
+                        emit_reused(dup_idx, dup_row, result)
+            
+            async def producer():
+                # 逐行读取CSV，凑满一批就可以开始请求
+                batch: List[Tuple[int, Dict, str]] = []
+                with open(input_path, 'r', encoding='utf-8', newline='') as f:
+                    reader = csv.DictReader(f)
+                    for idx, row in enumerate(reader):
+                        # 检查是否已处理
+                        if idx in cache:
+                            continue
+                        
+                        comment = " ".join([row.get(field, "") for field in comment_fields])
+                        if not comment.strip():
+                            progress.update(1)
+                            continue
+                        key = comment_digest(comment.strip())
+                        
+                        # 重复评论直接复用结果，或等待进行中的同一请求
+                        if key in finished:
+                            emit_reused(idx, row, finished[key])
+                            continue
+                        if key in pending:
+                            pending[key].append((idx, row))
+                            continue
+                        pending[key] = []
+                        
+                        batch.append((idx, row, comment))
+                        if len(batch) >= batch_size:
+                            await job_queue.put(batch)
+                            batch = []
                 
-                classification = self.classify_comment(comment)
+                if batch:
+                    await job_queue.put(batch)
                 
-                if classification["success"]:
-                    item = {
-                        "index": idx,
-                        **{k: v for k, v in row.items()},
-                        "raw_response": classification["raw_response"],
-                    }
-                    item.update(classification["result"] or {})
-                    # 保存到缓存
-                    self._save_to_cache(cache_path, item)
-                    results.append(item)
-                    success = True
-                    break
-                else:
-                    print(f"错误: {classification['error']}")
+                # 每个 worker 一个结束标记
+                for _ in range(concurrency):
+                    await job_queue.put(None)
             
-            if not success:
-                print(f"[{idx+1}/{total}] 处理失败，跳过")
-                item = {
-                    "index": idx,
-                    **{k: v for k, v in row.items()},
-                    "raw_response": None,
-                    "error": "error!",
-                }
-                # self._save_to_cache(cache_path, item)
-                results.append(item)
-        
-        # 保存最终结果
-        output_path = Path(output_file)
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        # save csv with pandas
-
-        df = pd.DataFrame(results)
-        df.to_csv(output_file, index=False, encoding='utf-8-sig')
-
-
+            async def worker():
+                while True:
+                    jobs = await job_queue.get()
+                    if jobs is None:
+                        break
+                    
+                    if len(jobs) == 1:
+                        idx, row, comment = jobs[0]
+                        items = [await self._classify_row(
+                            idx, row, comment, total, max_retries
+                        )]
+                    else:
+                        items = await self._classify_batch_rows(jobs, total, max_retries)
+                    emit_done(jobs, items)
+            
+            # 单遍流式读取缓存：成功条目直接写出并记为已处理（同一 index 只写一次）
+            # 同一 index 既有失败占位又有后来重试成功的条目时，以成功为准，
+            # 所以失败占位先暂存（数量很少），扫完再决定是否写出
+            failed_items: Dict[int, Dict] = {}
+            for item in self._iter_cache(cache_path):
+                idx = item['index']
+                if item.get(FAILED_KEY) is True:
+                    failed_items.setdefault(idx, item)
+                    continue
+                if idx in cache:
+                    continue
+                cache.add(idx)
+                emit(item)
+                # 缓存中的成功结果也参与去重，续跑时其重复评论不必再请求
+                comment = " ".join([str(item.get(field, "")) for field in comment_fields])
+                finished.setdefault(comment_digest(comment.strip()), parsed_fields(item))
+            # 失败占位默认也算已处理；retry_failed 时不算，以便重新请求
+            if not retry_failed:
+                for idx, item in failed_items.items():
+                    if idx not in cache:
+                        cache.add(idx)
+                        emit(item)
+            del failed_items
+            tqdm.write(f"已加载缓存: {len(cache)} 条记录")
+            
+            await asyncio.gather(producer(), *(worker() for _ in range(concurrency)))
+            result_writer.close()
         
         print(f"\n处理完成! 结果已保存至: {output_file}")
-        print(f"成功: {sum(1 for r in results if r.get('raw_response'))} 条")
-        print(f"失败: {sum(1 for r in results if not r.get('raw_response'))} 条")
+        print(f"成功: {stats['success']} 条")
+        print(f"失败: {stats['failed']} 条")
+        print(f"其中重复评论复用结果: {stats['reused']} 条")
 
 
 def main():
@@ -302,6 +864,11 @@ def main():
         default=os.getenv('DEFAULT_MODEL', 'gpt-4o-mini'),
         help='使用的模型（默认: gpt-4o-mini，支持环境变量 DEFAULT_MODEL）'
     )
+    parser.add_argument(
+        '--no-json-mode',
+        action='store_true',
+        help='不传 response_format（用于不支持 JSON 模式的 endpoint），改为从自由文本中提取 JSON'
+    )
     
     # Prompt配置
     parser.add_argument(
@@ -324,15 +891,57 @@ def main():
         default='cache',
         help='缓存目录（默认: cache）'
     )
+    parser.add_argument(
+        '--retry-failed',
+        action='store_true',
+        help='重新请求缓存中标记为失败的评论（默认跳过）'
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=20,
+        help='最大并发请求数（默认: 20）'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1,
+        help='每次请求打包的评论条数，大于 1 时要求模型返回 {"results": [...]} 形式的 JSON 对象（默认: 1）'
+    )
+    parser.add_argument(
+        '--max-rpm',
+        type=float,
+        default=500,
+        help='每分钟最大请求数（默认: 500）'
+    )
+    parser.add_argument(
+        '--max-tpm',
+        type=float,
+        default=200000,
+        help='每分钟最大 token 数（默认: 200000）'
+    )
     
     args = parser.parse_args()
     print(args)
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(message)s")
     
     # 检查API密钥
     if not args.api_key:
         print("错误: 请通过 --api-key 参数或 OPENAI_API_KEY 环境变量提供API密钥")
         return 1
     
+    if args.concurrency <= 0:
+        print("错误: --concurrency 必须大于 0")
+        return 1
+    
+    if args.batch_size <= 0:
+        print("错误: --batch-size 必须大于 0")
+        return 1
+    
+    if args.max_rpm <= 0 or args.max_tpm <= 0:
+        print("错误: --max-rpm 和 --max-tpm 必须大于 0")
+        return 1
+    
     # 创建分类器
     try:
         classifier = SentimentClassifier(
@@ -340,19 +949,32 @@ def main():
             base_url=args.base_url,
             model=args.model,
             system_prompt_path=args.prompt,
-            cache_dir=args.cache_dir
+            cache_dir=args.cache_dir,
+            max_rpm=args.max_rpm,
+            max_tpm=args.max_tpm,
+            json_mode=not args.no_json_mode,
+            max_connections=args.concurrency * 2
         )
     except FileNotFoundError as e:
         print(f"错误: {e}")
         return 1
     
     # 处理文件
-    classifier.process_csv(
-        input_file=args.input,
-        output_file=args.output,
-        comment_fields=args.comment_fields.split(','),
-        max_retries=args.max_retries
-    )
+    async def run():
+        try:
+            await classifier.process_csv(
+                input_file=args.input,
+                output_file=args.output,
+                comment_fields=args.comment_fields.split(','),
+                max_retries=args.max_retries,
+                concurrency=args.concurrency,
+                batch_size=args.batch_size,
+                retry_failed=args.retry_failed
+            )
+        finally:
+            await classifier.aclose()
+    
+    asyncio.run(run())
     
     return 0
 
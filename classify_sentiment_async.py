@@ -13,13 +13,10 @@ import asyncio
 import csv
 import json
 import os
-import re
 import time
 from pathlib import Path
 from typing import Dict, Optional, List, Tuple
 
-import pandas as pd
-
 
 try:
     from openai import AsyncOpenAI
@@ -29,17 +26,23 @@ except ImportError:
 
 
 def extract_json_from_llm(text: str):
-    """不管 AI 是否带 ```json，都能准确把字典提取出来。"""
-    markdown_pattern = r"```(?:json)?\s*([\s\S]*?)\s*```"
-    match = re.search(markdown_pattern, text)
-
-    if match:
-        json_str = match.group(1).strip()
-    else:
-        brace_pattern = r"(\{[\s\S]*\})"
-        match = re.search(brace_pattern, text)
-        if match:
-            json_str = match.group(1).strip()
+    """不管 AI 是否带 ```json，都能准确把字典提取出来（线性扫描，不使用正则）。"""
+    json_str = None
+
+    start = text.find("```")
+    if start != -1:
+        end = text.find("```", start + 3)
+        if end != -1:
+            json_str = text[start + 3:end]
+            if json_str.startswith("json"):
+                json_str = json_str[4:]
+            json_str = json_str.strip()
+
+    if json_str is None:
+        start = text.find("{")
+        end = text.rfind("}")
+        if start != -1 and end > start:
+            json_str = text[start:end + 1]
         else:
             json_str = text.strip()
 
@@ -262,8 +265,14 @@ class AsyncSentimentClassifier:
 
         output_path = Path(output_file)
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        df = pd.DataFrame(results)
-        df.to_csv(output_file, index=False, encoding="utf-8-sig")
+        # 表头取所有结果字段的并集（按首次出现顺序），缺失字段留空
+        fieldnames: Dict[str, None] = {}
+        for item in results:
+            fieldnames.update(dict.fromkeys(item))
+        with open(output_path, "w", encoding="utf-8-sig", newline="") as f:
+            csv_writer = csv.DictWriter(f, fieldnames=list(fieldnames), restval="")
+            csv_writer.writeheader()
+            csv_writer.writerows(results)
 
         print(f"\n处理完成! 结果已保存至: {output_file}")
         print(f"成功: {sum(1 for r in results if r.get('raw_response'))} 条")